@@ -0,0 +1,102 @@
+"""Бенчмарк слоя БД: запросы через f-строки против параметризованных.
+
+Создает во временной папке БД бота, наполняет ее 100k пользователей и 100k
+записей избранного и считает операции в секунду для трех вариантов:
+  f-строки   - SQL как в исходном Database (каждый запрос компилируется заново)
+  параметры  - те же запросы с ?, текст один - работает кэш выражений sqlite3
+  Database   - методы текущего Database целиком (асинхронно, через пул потоков)
+
+Запуск из корня репозитория: python bench/db_bench.py [операций]
+"""
+import os
+import sys
+import random
+import sqlite3
+import asyncio
+import tempfile
+import importlib.util
+from time import perf_counter, time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+users = 100000
+favourites = 100000
+films = 20000
+
+def load_bot():
+    # Бот создает DataBase.db в текущей папке - импортируем его во временной
+    os.chdir(tempfile.mkdtemp())
+    spec = importlib.util.spec_from_file_location('bot', os.path.join(root, 'р.py'))
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
+
+def seed(sql):
+    random.seed(1)
+    sql.executemany("INSERT INTO user_data(user_id, user_menotion, user_error_link_complaint_unix, user_unix) "
+                    "VALUES(?, ?, NULL, ?)", [(i, f'@user{i}', time()) for i in range(1, users + 1)])
+    sql.executemany("INSERT INTO films_names(id, name) VALUES(?, ?)", [(i, f'Фильм {i}') for i in range(1, films + 1)])
+    sql.executemany("INSERT INTO films_data(films_code, films_name, films_priv, films_id) VALUES(?, ?, ?, ?)",
+                    [(f'{i:05}', f'Фильм {i}', None, i) for i in range(1, films + 1)])
+    sql.executemany("INSERT OR IGNORE INTO favourites_data VALUES(?, ?)",
+                    [(random.randint(1, users), str(random.randint(1, films))) for _ in range(favourites)])
+    sql.commit()
+
+# Операции: (название, SQL через f-строку, параметризованный SQL, метод Database, генератор аргументов)
+operations = [
+    ('get_films',
+     lambda code: f"SELECT * FROM films_data WHERE films_code = '{code}'",
+     "SELECT * FROM films_data WHERE films_code = ?",
+     lambda db, code: db.get_films(code),
+     lambda: [f'{random.randint(1, films):05}']),
+    ('get_filmname',
+     lambda id: f"SELECT * FROM films_names WHERE id = {id}",
+     "SELECT * FROM films_names WHERE id = ?",
+     lambda db, id: db.get_filmname(id),
+     lambda: [random.randint(1, films)]),
+    ('get_UserFavouritesWfilm',
+     lambda user_id, name: f"SELECT * FROM favourites_data WHERE favourites_uid = {user_id} and favourites_id = {name}",
+     "SELECT * FROM favourites_data WHERE favourites_uid = ? and favourites_id = ?",
+     lambda db, user_id, name: db.get_UserFavouritesWfilm(user_id, name),
+     lambda: [random.randint(1, users), str(random.randint(1, films))]),
+    ('get_error_link_complaint',
+     lambda user_id: f"SELECT user_error_link_complaint_unix FROM user_data WHERE user_id = {user_id}",
+     "SELECT user_error_link_complaint_unix FROM user_data WHERE user_id = ?",
+     lambda db, user_id: db.get_error_link_complaint_unix(user_id),
+     lambda: [random.randint(1, users)]),
+]
+
+def run_sql(sql, make_query, args_list, parameterized):
+    start = perf_counter()
+    for args in args_list:
+        if parameterized:
+            sql.execute(make_query, args).fetchall()
+        else:
+            sql.execute(make_query(*args)).fetchall()
+    return len(args_list) / (perf_counter() - start)
+
+async def run_database(db, method, args_list):
+    start = perf_counter()
+    for args in args_list:
+        await method(db, *args)
+    return len(args_list) / (perf_counter() - start)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bot = load_bot()
+    seed(bot.db.sql)
+    sql = sqlite3.connect('DataBase.db')
+    print(f'Пользователей: {users}, избранного: {favourites}, фильмов: {films}, операций: {count}\n')
+    print(f'{"операция":<26} {"f-строки":>10} {"параметры":>10} {"Database":>10}  (опер./с)')
+
+    for name, fstring_query, query, method, make_args in operations:
+        args_list = [make_args() for _ in range(count)]
+        before = run_sql(sql, fstring_query, args_list, parameterized=False)
+        after = run_sql(sql, query, args_list, parameterized=True)
+        full = asyncio.run(run_database(bot.db, method, args_list))
+        print(f'{name:<26} {before:>10.0f} {after:>10.0f} {full:>10.0f}')
+
+    sql.close()
+    bot.db.close()
+
+if __name__ == '__main__':
+    main()
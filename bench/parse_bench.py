@@ -0,0 +1,59 @@
+"""Микро-бенчмарк разбора страницы поиска Кинопоиска.
+
+Сравнивает прежний разбор (полное дерево html.parser) с FilmParser.parse
+(SoupStrainer + lxml, если установлен) на сохраненных страницах из fixtures/:
+время одного разбора и память, выделенная за разбор.
+
+Запуск из корня репозитория: python bench/parse_bench.py [повторов]
+"""
+import os
+import sys
+import tempfile
+import importlib.util
+import timeit
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fixtures = os.path.join(root, 'bench', 'fixtures')
+
+def load_bot():
+    # Бот создает DataBase.db в текущей папке - импортируем его во временной
+    os.chdir(tempfile.mkdtemp())
+    spec = importlib.util.spec_from_file_location('bot', os.path.join(root, 'р.py'))
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
+
+def parse_full_tree(html):
+    # Разбор до оптимизации: дерево всей страницы, из него берется первый результат
+    soup = BeautifulSoup(html, 'html.parser')
+    element = soup.find(class_='element most_wanted')
+    return element.find(class_='pic').find('a')['data-id']
+
+def measure(func, html, number):
+    seconds = min(timeit.repeat(lambda: func(html), number=number, repeat=3)) / number
+    tracemalloc.start()
+    func(html)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    bot = load_bot()
+    print(f'Бэкенд FilmParser: {bot.html_parser}, повторов: {number}\n')
+    print(f'{"страница":<20} {"разбор":<14} {"мс/разбор":>10} {"пик памяти, КиБ":>16}')
+
+    for name in sorted(os.listdir(fixtures)):
+        with open(os.path.join(fixtures, name), encoding='utf-8') as file:
+            html = file.read()
+        for label, func in (('полное дерево', parse_full_tree), ('FilmParser', bot.FilmParser.parse)):
+            seconds, peak = measure(func, html, number)
+            print(f'{name:<20} {label:<14} {seconds * 1000:>10.2f} {peak / 1024:>16.1f}')
+
+    bot.db.close()
+
+if __name__ == '__main__':
+    main()
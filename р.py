@@ -3,28 +3,71 @@
 # @K1p1k | Загружено с TG @KiTools
 
 import asyncio
+import io
 import re
+import csv
+import gzip
 import json
+import shutil
+import tempfile
 import sqlite3
 import logging
+import threading
 from time import time
-from random import randint
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd
+from random import randrange
+from difflib import SequenceMatcher
 from datetime import datetime, timedelta
 
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
+from bs4 import BeautifulSoup, SoupStrainer
 from aiogram import Bot, Dispatcher, types, executor
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import BoundFilter, CommandStart
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.utils.markdown import quote_html
+from aiogram.utils.exceptions import (RetryAfter, MessageNotModified, BotBlocked, BotKicked, UserDeactivated,
+                                      ChatNotFound, CantInitiateConversation, CantTalkWithBots)
+
+try:
+    import lxml  # Быстрый парсер HTML, если установлен
+    html_parser = 'lxml'
+except ImportError:
+    html_parser = 'html.parser'
 
 # ==================== КОНФИГУРАЦИЯ ====================
 token = '8189356827:AAFz5RM1NhYMf5ycn9STeSha2h1uqBRCC2E'  # Вставьте токен бота от @BotFather
 admin_id = [5858391454]  # ID администраторов [12345, 67890]
 rate_searsh = 1  # Задержка между поисками в секундах
 bot_version = '1.9'
+http_timeout = 10  # Таймаут запроса к Кинопоиску в секундах
+http_limit = 10  # Максимум одновременных запросов к Кинопоиску
+cache_size = 1000  # Сколько результатов поиска держать в памяти
+cache_ttl = 3600  # Время жизни результата в памяти в секундах
+cache_db_ttl = 7 * 24 * 3600  # Время жизни результата в БД в секундах
+sub_cache_ttl = 60  # Сколько секунд не перепроверять подписанного пользователя
+sub_error_interval = 3600  # Как часто сообщать админу об ошибке одного канала
+db_read_pool = 4  # Количество потоков для чтения из БД
+db_flush_interval = 0.5  # Как часто сбрасывать отложенные записи в БД в секундах
+db_flush_rows = 500  # Сбросить раньше, если накопилось столько записей
+mailing_rate = 25  # Сообщений в секунду при рассылке (общий лимит Telegram ~30)
+mailing_workers = 10  # Одновременных отправок при рассылке
+mailing_progress_interval = 3  # Как часто обновлять прогресс рассылки в секундах
+mailing_attempts = 3  # Сколько раз повторять отправку при временной ошибке
+activity_interval = 600  # Как часто обновлять время последней активности пользователя в секундах
+stats_top = 5  # Сколько популярных запросов показывать в статистике
+export_gzip_size = 1024 * 1024  # Выгрузки больше этого размера сжимаются gzip
+film_code_length = 4  # Длина сгенерированного кода фильма
+film_code_alphabet = '0123456789'  # Символы сгенерированного кода фильма
+local_search_score = 0.85  # Минимальное сходство названия для подсказок inline-режима
+search_results = 5  # Сколько результатов поиска показывать в подборке
+inline_limit = 10  # Максимум результатов в inline-режиме
+inline_cache_time = 300  # Сколько секунд хранятся результаты inline-запроса (у нас и в Telegram)
 
 # ==================== ИНИЦИАЛИЗАЦИЯ БОТА ====================
 storage = MemoryStorage()
@@ -51,12 +94,168 @@ class AdminState(StatesGroup):
     chennger_film_text = State()
     import_cfg_file = State()
 
+# ==================== НАЗВАНИЯ ====================
+def normalize_query(name):
+    return ' '.join(name.lower().replace('ё', 'е').split())
+
+translit_table = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z', 'и': 'i',
+    'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's',
+    'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'c', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '',
+    'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya'
+})
+
+def translit(name):
+    # Кириллица и латиница приводятся к одному виду: "матрица" и "matrica" совпадают
+    return name.translate(translit_table)
+
 # ==================== БАЗА ДАННЫХ ====================
 class Database:
     def __init__(self):
-        self.sql = sqlite3.connect('DataBase.db')
+        # Соединение для записи: используется только потоком writer
+        self.sql = self.connect()
+        self.sql.execute("PRAGMA journal_mode=WAL")
         self.cs = self.sql.cursor()
         self.create_tables()
+        
+        # Отложенные записи (история поиска, регистрация, названия) пишутся пачкой
+        self.pending = []
+        self.pending_filmnames = {}
+        self.flush_event = None
+        self.cs.execute("SELECT 1 FROM sqlite_master WHERE name = 'titles_index'")
+        self.fts = bool(self.cs.fetchone())
+        
+        self.cs.execute("SELECT MAX(seq) FROM sqlite_sequence WHERE name = 'films_names'")
+        self.filmname_id = self.cs.fetchone()[0] or 0
+        
+        # Плееры и каналы: несколько строк, меняются только админом - держим в памяти
+        self.registry = {}
+        
+        self.local = threading.local()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db_writer')
+        self.readers = ThreadPoolExecutor(max_workers=db_read_pool, thread_name_prefix='db_reader')
+    
+    @staticmethod
+    def connect():
+        sql = sqlite3.connect('DataBase.db', cached_statements=256, check_same_thread=False)
+        sql.execute("PRAGMA synchronous=NORMAL")
+        sql.execute("PRAGMA busy_timeout=5000")
+        return sql
+    
+    def reader(self):
+        # У каждого потока чтения свое соединение
+        sql = getattr(self.local, 'sql', None)
+        if sql is None:
+            sql = self.local.sql = self.connect()
+        return sql
+    
+    async def fetchall(self, query, params=()):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.readers, lambda: self.reader().execute(query, params).fetchall())
+    
+    async def fetchone(self, query, params=()):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.readers, lambda: self.reader().execute(query, params).fetchone())
+    
+    async def iterate(self, query, params=(), page_size=1000):
+        # Keyset-пагинация: первая колонка - ключ, последние параметры запроса - ключ и размер страницы
+        last_key = -2 ** 63
+        while True:
+            page = await self.fetchall(query, [*params, last_key, page_size])
+            for row in page:
+                yield row
+            if len(page) < page_size:
+                return
+            last_key = page[-1][0]
+    
+    async def export(self, query, header, format):
+        # Выгрузка целиком выполняется в потоке чтения, строки читаются порциями
+        def work():
+            # Обычный TemporaryFile: SpooledTemporaryFile до Python 3.11 не принимают TextIOWrapper и InputFile
+            buffer = tempfile.TemporaryFile()
+            text = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+            cursor = self.reader().execute(query)
+            
+            if format == 'csv':
+                writer = csv.writer(text)
+                writer.writerow(header)
+                while rows := cursor.fetchmany(1000):
+                    writer.writerows(rows)
+            else:
+                separator = '['
+                while rows := cursor.fetchmany(1000):
+                    for row in rows:
+                        text.write(separator + '\n' + json.dumps(dict(zip(header, row)), ensure_ascii=False))
+                        separator = ','
+                text.write('[]\n' if separator == '[' else '\n]\n')
+            
+            text.flush()
+            text.detach()
+            if buffer.tell() <= export_gzip_size:
+                buffer.seek(0)
+                return buffer, False
+            
+            buffer.seek(0)
+            compressed = tempfile.TemporaryFile()
+            with gzip.GzipFile(fileobj=compressed, mode='wb') as gz:
+                shutil.copyfileobj(buffer, gz)
+            buffer.close()
+            compressed.seek(0)
+            return compressed, True
+        
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.readers, work)
+    
+    async def transaction(self, func):
+        # Все записи идут по очереди через один поток и одно соединение
+        def work():
+            with self.sql:
+                return func(self.sql)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.writer, work)
+    
+    async def execute(self, query, params=()):
+        return await self.transaction(lambda sql: sql.execute(query, params))
+    
+    def defer(self, query, params):
+        self.pending.append((query, params))
+        if len(self.pending) >= db_flush_rows and self.flush_event:
+            self.flush_event.set()
+    
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        filmname_ids = list(self.pending_filmnames)
+        
+        def work(sql):
+            for query, params in batch:
+                try:
+                    sql.execute(query, params)
+                except sqlite3.Error as e:
+                    logging.error(f'Ошибка отложенной записи: {e}')
+        await self.transaction(work)
+        
+        for id in filmname_ids:
+            self.pending_filmnames.pop(id, None)
+    
+    async def flush_loop(self):
+        self.flush_event = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), db_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f'Ошибка записи в БД: {e}')
+    
+    def close(self):
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+        self.sql.close()
     
     def create_tables(self):
         # Таблица пользователей
@@ -120,9 +319,191 @@ class Database:
             name TEXT
         )""")
         
+        # Кэш результатов поиска на Кинопоиске
+        self.cs.execute("""CREATE TABLE IF NOT EXISTS search_cache(
+            cache_query TEXT PRIMARY KEY,
+            film_id TEXT,
+            film_name TEXT,
+            film_year TEXT,
+            film_type TEXT,
+            film_genre TEXT,
+            film_director TEXT,
+            film_autor TEXT,
+            film_length TEXT,
+            film_photo TEXT,
+            cache_unix INTEGER
+        )""")
+        
         self.sql.commit()
+        self.migrate()
         self.init_default_data()
     
+    def migrate(self):
+        # Номер миграции = версия схемы (PRAGMA user_version), старые БД обновляются при запуске
+        migrations = [
+            self.migration_kp_columns,
+            self.migration_indexes,
+            self.migration_mailing,
+            self.migration_user_active,
+            self.migration_stats,
+            self.migration_sequence,
+            self.migration_titles,
+            self.migration_search_rank,
+        ]
+        self.cs.execute("PRAGMA user_version")
+        version = self.cs.fetchone()[0]
+        for number, migration in enumerate(migrations[version:], version + 1):
+            logging.info(f'Миграция БД до версии {number}')
+            # Без явной транзакции sqlite3 сразу фиксирует DDL: прерванная миграция оставила бы половину схемы
+            self.cs.execute("BEGIN")
+            try:
+                migration()
+                self.cs.execute(f"PRAGMA user_version = {number}")
+                self.sql.commit()
+            except:
+                self.sql.rollback()
+                raise
+    
+    def migration_kp_columns(self):
+        # Данные Кинопоиска, найденные при первом поиске
+        self.add_columns('films_names', [
+            ('kp_id', 'TEXT'), ('kp_name', 'TEXT'), ('kp_year', 'TEXT'), ('kp_type', 'TEXT'),
+            ('kp_genre', 'TEXT'), ('kp_director', 'TEXT'), ('kp_autor', 'TEXT'),
+            ('kp_length', 'TEXT'), ('kp_photo', 'TEXT')
+        ])
+        self.add_columns('films_data', [('films_kp_id', 'TEXT'), ('films_kp_type', 'TEXT')])
+    
+    def migration_indexes(self):
+        # Перед уникальным индексом убираем дубли избранного
+        self.cs.execute("""DELETE FROM favourites_data WHERE rowid NOT IN (
+            SELECT MIN(rowid) FROM favourites_data GROUP BY favourites_uid, favourites_id
+        )""")
+        self.cs.execute("""CREATE UNIQUE INDEX IF NOT EXISTS favourites_data_uid_id
+            ON favourites_data(favourites_uid, favourites_id)""")
+        self.cs.execute("CREATE INDEX IF NOT EXISTS user_data_unix ON user_data(user_unix)")
+    
+    def migration_mailing(self):
+        # Рассылки и статус доставки каждому получателю
+        self.cs.execute("""CREATE TABLE IF NOT EXISTS mailing_data(
+            mailing_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            mailing_chat_id INTEGER,
+            mailing_message_id INTEGER,
+            mailing_markup TEXT,
+            mailing_status TEXT,
+            mailing_progress_id INTEGER,
+            mailing_unix INTEGER
+        )""")
+        self.cs.execute("""CREATE TABLE IF NOT EXISTS mailing_users(
+            mailing_id INTEGER,
+            user_id INTEGER,
+            status TEXT,
+            PRIMARY KEY(mailing_id, user_id)
+        ) WITHOUT ROWID""")
+    
+    def migration_user_active(self):
+        # 0 - пользователь заблокировал бота или удален, рассылки его пропускают
+        self.add_columns('user_data', [('user_active', 'INTEGER DEFAULT 1')])
+    
+    def migration_stats(self):
+        # Последняя активность пользователя для DAU/WAU/MAU
+        self.add_columns('user_data', [('user_last_unix', 'INTEGER')])
+        self.cs.execute("UPDATE user_data SET user_last_unix = user_unix WHERE user_last_unix IS NULL")
+        self.cs.execute("CREATE INDEX IF NOT EXISTS user_data_last_unix ON user_data(user_last_unix)")
+        self.cs.execute("CREATE INDEX IF NOT EXISTS search_data_count ON search_data(search_count)")
+        
+        # Счетчики, которые триггеры поддерживают в актуальном состоянии
+        self.cs.execute("""CREATE TABLE IF NOT EXISTS stats_data(
+            stats_key TEXT PRIMARY KEY,
+            stats_value INTEGER
+        )""")
+        self.cs.execute("""INSERT OR REPLACE INTO stats_data VALUES
+            ('users', (SELECT COUNT(*) FROM user_data)),
+            ('users_active', (SELECT COUNT(*) FROM user_data WHERE user_active = 1)),
+            ('films', (SELECT COUNT(*) FROM films_data))""")
+        self.cs.execute("""CREATE TRIGGER IF NOT EXISTS stats_user_insert AFTER INSERT ON user_data BEGIN
+            UPDATE stats_data SET stats_value = stats_value + 1 WHERE stats_key = 'users';
+            UPDATE stats_data SET stats_value = stats_value + (NEW.user_active = 1) WHERE stats_key = 'users_active';
+        END""")
+        self.cs.execute("""CREATE TRIGGER IF NOT EXISTS stats_user_delete AFTER DELETE ON user_data BEGIN
+            UPDATE stats_data SET stats_value = stats_value - 1 WHERE stats_key = 'users';
+            UPDATE stats_data SET stats_value = stats_value - (OLD.user_active = 1) WHERE stats_key = 'users_active';
+        END""")
+        self.cs.execute("""CREATE TRIGGER IF NOT EXISTS stats_user_active AFTER UPDATE OF user_active ON user_data BEGIN
+            UPDATE stats_data SET stats_value = stats_value + (NEW.user_active = 1) - (OLD.user_active = 1)
+                WHERE stats_key = 'users_active';
+        END""")
+        self.cs.execute("""CREATE TRIGGER IF NOT EXISTS stats_film_insert AFTER INSERT ON films_data BEGIN
+            UPDATE stats_data SET stats_value = stats_value + 1 WHERE stats_key = 'films';
+        END""")
+        self.cs.execute("""CREATE TRIGGER IF NOT EXISTS stats_film_delete AFTER DELETE ON films_data BEGIN
+            UPDATE stats_data SET stats_value = stats_value - 1 WHERE stats_key = 'films';
+        END""")
+    
+    def migration_titles(self):
+        # Названия фильмов и запросы, на которые ответил Кинопоиск (в транслите) -> id, с trigram-индексом FTS5
+        self.cs.execute("CREATE INDEX IF NOT EXISTS search_cache_film_id ON search_cache(film_id)")
+        self.cs.execute("""CREATE TABLE IF NOT EXISTS titles_data(
+            title TEXT,
+            film_id TEXT,
+            UNIQUE(title, film_id)
+        )""")
+        try:
+            self.cs.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS titles_index
+                USING fts5(title, film_id UNINDEXED, content='titles_data', tokenize='trigram')""")
+        except sqlite3.OperationalError as e:
+            logging.warning(f'FTS5 trigram недоступен, локальный поиск отключен: {e}')
+            return
+        self.cs.execute("""CREATE TRIGGER IF NOT EXISTS titles_data_insert AFTER INSERT ON titles_data BEGIN
+            INSERT INTO titles_index(rowid, title, film_id) VALUES(NEW.rowid, NEW.title, NEW.film_id);
+        END""")
+        
+        self.cs.execute("SELECT cache_query, film_name, film_id FROM search_cache")
+        rows = self.cs.fetchall()
+        self.cs.execute("""SELECT films_name, films_name, films_kp_id FROM films_data
+            WHERE films_kp_id IS NOT NULL""")
+        rows += self.cs.fetchall()
+        self.cs.executemany("INSERT OR IGNORE INTO titles_data(title, film_id) VALUES(?, ?)",
+                            [(translit(normalize_query(title)), film_id)
+                             for query, name, film_id in rows for title in (query, name) if title])
+    
+    def migration_search_rank(self):
+        # Кэш хранит всю подборку результатов запроса, cache_rank - место в выдаче
+        self.cs.execute("""CREATE TABLE search_cache_rank(
+            cache_query TEXT,
+            cache_rank INTEGER,
+            film_id TEXT,
+            film_name TEXT,
+            film_year TEXT,
+            film_type TEXT,
+            film_genre TEXT,
+            film_director TEXT,
+            film_autor TEXT,
+            film_length TEXT,
+            film_photo TEXT,
+            cache_unix INTEGER,
+            PRIMARY KEY(cache_query, cache_rank)
+        )""")
+        self.cs.execute("""INSERT INTO search_cache_rank SELECT cache_query, 0, film_id, film_name, film_year,
+            film_type, film_genre, film_director, film_autor, film_length, film_photo, cache_unix FROM search_cache""")
+        self.cs.execute("DROP TABLE search_cache")
+        self.cs.execute("ALTER TABLE search_cache_rank RENAME TO search_cache")
+        self.cs.execute("CREATE INDEX IF NOT EXISTS search_cache_film_id ON search_cache(film_id)")
+    
+    def migration_sequence(self):
+        # Счетчики для генерации кодов
+        self.cs.execute("""CREATE TABLE IF NOT EXISTS sequence_data(
+            sequence_name TEXT PRIMARY KEY,
+            sequence_value INTEGER
+        )""")
+    
+    def add_columns(self, table, columns):
+        # Добавляет недостающие колонки в уже существующую таблицу
+        self.cs.execute(f"PRAGMA table_info({table})")
+        existing = [i[1] for i in self.cs.fetchall()]
+        for name, column_type in columns:
+            if name not in existing:
+                self.cs.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+    
     def init_default_data(self):
         # Добавление плееров по умолчанию
         try:
@@ -172,164 +553,403 @@ class Database:
         return [i[0] for i in kortage]
     
     async def get_AllText(self, type='*'):
-        self.cs.execute(f"SELECT {type} FROM text_data")
-        return self.cs.fetchall()
-    
-    async def add_filmname(self, name):
-        self.cs.execute("INSERT INTO films_names(name) VALUES(?)", [name])
-        self.sql.commit()
-        return self.cs.lastrowid
+        return await self.fetchall(f"SELECT {type} FROM text_data")
+    
+    async def add_filmname(self, name, kp_values=None):
+        # id выдается сразу, а строка попадает в БД со следующей пачкой
+        kp_values = kp_values or [None] * len(FilmData.fields)
+        self.filmname_id += 1
+        row = (self.filmname_id, name, *kp_values)
+        self.pending_filmnames[self.filmname_id] = row
+        self.defer("""INSERT INTO films_names(id, name, kp_id, kp_name, kp_year, kp_type, kp_genre,
+            kp_director, kp_autor, kp_length, kp_photo) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", row)
+        return self.filmname_id
+    
+    async def update_filmname_kp(self, id, kp_values):
+        id = int(id)
+        if id in self.pending_filmnames:
+            self.pending_filmnames[id] = (id, self.pending_filmnames[id][1], *kp_values)
+        self.defer("""UPDATE films_names SET kp_id = ?, kp_name = ?, kp_year = ?, kp_type = ?,
+            kp_genre = ?, kp_director = ?, kp_autor = ?, kp_length = ?, kp_photo = ? WHERE id = ?""",
+                   [*kp_values, id])
     
     async def get_filmname(self, id):
-        self.cs.execute(f"SELECT * FROM films_names WHERE id = {id}")
-        return self.cs.fetchone()
+        row = self.pending_filmnames.get(int(id))
+        if row:
+            return row
+        return await self.fetchone("SELECT * FROM films_names WHERE id = ?", [id])
     
     async def add_user(self, user_id, user_menotion):
-        try:
-            self.cs.execute("INSERT INTO user_data VALUES(?, ?, ?, ?)", 
-                           [user_id, user_menotion, None, time()])
-            self.sql.commit()
-        except:
-            pass
+        # Повторный /start возвращает пользователя в рассылки
+        self.defer("""INSERT INTO user_data(user_id, user_menotion, user_error_link_complaint_unix, user_unix,
+            user_active, user_last_unix) VALUES(?, ?, ?, ?, 1, ?)
+            ON CONFLICT(user_id) DO UPDATE SET user_active = 1, user_last_unix = excluded.user_last_unix""", 
+                   [user_id, user_menotion, None, time(), time()])
+    
+    def deactivate_user(self, user_id):
+        self.defer("UPDATE user_data SET user_active = 0 WHERE user_id = ?", [user_id])
+    
+    def touch_user(self, user_id):
+        self.defer("UPDATE user_data SET user_last_unix = ? WHERE user_id = ?", [time(), user_id])
+    
+    async def get_Stats(self):
+        return dict(await self.fetchall("SELECT stats_key, stats_value FROM stats_data"))
+    
+    async def get_countUsers(self, type, since):
+        result = await self.fetchone(f"SELECT COUNT(*) FROM user_data WHERE {type} >= ?", [since])
+        return result[0]
     
     async def get_AllUser(self, type='*'):
-        self.cs.execute(f"SELECT {type} FROM user_data")
-        return self.cs.fetchall()
+        return await self.fetchall(f"SELECT {type} FROM user_data")
     
-    async def add_film(self, code, name, priv, id):
-        self.cs.execute("INSERT INTO films_data VALUES(?, ?, ?, ?)", [code, name, priv, id])
-        self.sql.commit()
+    async def add_film(self, code, name, priv, id, kp_id=None, kp_type=None):
+        # id ссылается на films_names: строка с ним должна попасть в БД раньше
+        await self.flush()
+        await self.execute("INSERT INTO films_data VALUES(?, ?, ?, ?, ?, ?)", [code, name, priv, id, kp_id, kp_type])
+    
+    async def update_film_kp(self, code, kp_id, kp_type):
+        await self.execute("UPDATE films_data SET films_kp_id = ?, films_kp_type = ? WHERE films_code = ?",
+                           [kp_id, kp_type, code])
     
     async def get_AllFilms(self, type='*'):
-        self.cs.execute(f"SELECT {type} FROM films_data")
-        return self.cs.fetchall()
+        return await self.fetchall(f"SELECT {type} FROM films_data")
+    
+    def add_title(self, title, film_id):
+        if self.fts:
+            self.defer("INSERT OR IGNORE INTO titles_data(title, film_id) VALUES(?, ?)", [title, film_id])
+    
+    async def search_titles(self, match, limit):
+        return await self.fetchall("""SELECT title, film_id FROM titles_index
+            WHERE titles_index MATCH ? ORDER BY rank LIMIT ?""", [match, limit])
+    
+    async def get_filmCache(self, film_id):
+        return await self.fetchone("""SELECT film_id, film_name, film_year, film_type, film_genre,
+            film_director, film_autor, film_length, film_photo
+            FROM search_cache WHERE film_id = ? ORDER BY cache_unix DESC LIMIT 1""", [film_id])
+    
+    async def next_sequence(self, name):
+        def work(sql):
+            sql.execute("INSERT OR IGNORE INTO sequence_data VALUES(?, 0)", [name])
+            sql.execute("UPDATE sequence_data SET sequence_value = sequence_value + 1 WHERE sequence_name = ?", [name])
+            return sql.execute("SELECT sequence_value FROM sequence_data WHERE sequence_name = ?", [name]).fetchone()[0]
+        return await self.transaction(work)
     
     async def get_films(self, code):
-        self.cs.execute(f"SELECT * FROM films_data WHERE films_code = '{code}'")
-        return self.cs.fetchall()
+        return await self.fetchall("SELECT * FROM films_data WHERE films_code = ?", [code])
     
     async def delete_Film(self, code):
-        self.cs.execute(f"SELECT films_code FROM films_data WHERE films_code = '{code}'")
-        if not self.cs.fetchall():
-            return False
-        self.cs.execute(f"DELETE FROM films_data WHERE films_code = '{code}'")
-        self.sql.commit()
-        return True
+        cursor = await self.execute("DELETE FROM films_data WHERE films_code = ?", [code])
+        return cursor.rowcount > 0
     
     async def get_error_link_complaint_unix(self, user_id):
-        self.cs.execute(f"SELECT user_error_link_complaint_unix FROM user_data WHERE user_id = {user_id}")
-        result = self.cs.fetchone()
+        result = await self.fetchone("SELECT user_error_link_complaint_unix FROM user_data WHERE user_id = ?", [user_id])
         return result[0] if result else None
     
     async def update_error_link_complaint_unix(self, user_id, time_ub):
-        self.cs.execute(f"UPDATE user_data SET user_error_link_complaint_unix = {time_ub} WHERE user_id = {user_id}")
-        self.sql.commit()
+        await self.execute("UPDATE user_data SET user_error_link_complaint_unix = ? WHERE user_id = ?", [time_ub, user_id])
+    
+    async def load_registry(self, table):
+        self.registry[table] = await self.fetchall(f"SELECT * FROM {table}")
+    
+    async def get_registry(self, table):
+        if table not in self.registry:
+            await self.load_registry(table)
+        return self.registry[table]
     
     async def add_Chennel(self, chennel_identifier, name, link):
-        self.cs.execute("INSERT INTO chennel_data VALUES(?, ?, ?)", [chennel_identifier, name, link])
-        self.sql.commit()
+        await self.execute("INSERT INTO chennel_data VALUES(?, ?, ?)", [chennel_identifier, name, link])
+        await self.load_registry('chennel_data')
     
     async def get_AllChennel(self, type='*'):
-        self.cs.execute(f"SELECT {type} FROM chennel_data")
-        return self.cs.fetchall()
+        if type == '*':
+            return await self.get_registry('chennel_data')
+        return await self.fetchall(f"SELECT {type} FROM chennel_data")
     
     async def update_nameChennel(self, chennel_identifier, name):
-        self.cs.execute(f"UPDATE chennel_data SET chennel_name = '{name}' WHERE chennel_identifier = '{chennel_identifier}'")
-        self.sql.commit()
+        await self.execute("UPDATE chennel_data SET chennel_name = ? WHERE chennel_identifier = ?", [name, chennel_identifier])
+        await self.load_registry('chennel_data')
     
     async def delete_Chennel(self, chennel_identifier):
-        self.cs.execute(f"SELECT * FROM chennel_data WHERE chennel_identifier = '{chennel_identifier}'")
-        if not self.cs.fetchall():
-            return False
-        self.cs.execute(f"DELETE FROM chennel_data WHERE chennel_identifier = '{chennel_identifier}'")
-        self.sql.commit()
-        return True
+        cursor = await self.execute("DELETE FROM chennel_data WHERE chennel_identifier = ?", [chennel_identifier])
+        await self.load_registry('chennel_data')
+        return cursor.rowcount > 0
     
     async def get_Allplayer(self, type='*'):
-        self.cs.execute(f"SELECT {type} FROM player_data")
-        return self.cs.fetchall()
+        if type == '*':
+            return await self.get_registry('player_data')
+        return await self.fetchall(f"SELECT {type} FROM player_data")
     
     async def swich_player(self, player_name):
-        self.cs.execute(f"SELECT switch FROM player_data WHERE player_name = '{player_name}'")
-        data_swich = self.cs.fetchone()
-        if data_swich:
-            edit = 0 if data_swich[0] == 1 else 1
-            self.cs.execute(f"UPDATE player_data SET switch = {edit} WHERE player_name = '{player_name}'")
-            self.sql.commit()
+        await self.execute("UPDATE player_data SET switch = NOT switch WHERE player_name = ?", [player_name])
+        await self.load_registry('player_data')
     
     async def update_kbname_player(self, player_name, kb):
-        self.cs.execute(f"UPDATE player_data SET kb_name = '{kb}' WHERE player_name = '{player_name}'")
-        self.sql.commit()
+        await self.execute("UPDATE player_data SET kb_name = ? WHERE player_name = ?", [kb, player_name])
+        await self.load_registry('player_data')
     
     async def get_text(self, type, text_type):
-        self.cs.execute(f"SELECT {type} FROM text_data WHERE text_type = '{text_type}'")
-        return self.cs.fetchall()
+        return await self.fetchall(f"SELECT {type} FROM text_data WHERE text_type = ?", [text_type])
     
     async def update_wellcome_text(self, text, text_type):
-        self.cs.execute(f"UPDATE text_data SET text_text = '{text}' WHERE text_type = '{text_type}'")
-        self.sql.commit()
+        await self.execute("UPDATE text_data SET text_text = ? WHERE text_type = ?", [text, text_type])
     
     async def add_historyInSearch(self, name):
-        try:
-            self.cs.execute("INSERT INTO search_data VALUES(?, ?)", [name, 1])
-        except:
-            self.cs.execute(f"UPDATE search_data SET search_count = search_count + 1 WHERE search_film = '{name}'")
-        self.sql.commit()
+        self.defer("""INSERT INTO search_data VALUES(?, 1)
+            ON CONFLICT(search_film) DO UPDATE SET search_count = search_count + 1""", [name])
     
     async def get_AllSearch(self, type='*'):
-        self.cs.execute(f"SELECT {type} FROM search_data")
-        return self.cs.fetchall()
+        return await self.fetchall(f"SELECT {type} FROM search_data")
+    
+    async def get_topSearch(self, limit):
+        return await self.fetchall("SELECT * FROM search_data ORDER BY search_count DESC LIMIT ?", [limit])
     
     async def get_AllFranchise(self, type='*'):
-        self.cs.execute(f"SELECT {type} FROM franchise_data")
-        return self.cs.fetchall()
+        return await self.fetchall(f"SELECT {type} FROM franchise_data")
     
     async def add_favourite(self, user_id, name):
-        self.cs.execute(f"SELECT * FROM favourites_data WHERE favourites_uid = {user_id} and favourites_id = {name}")
-        if self.cs.fetchall():
-            return False
-        self.cs.execute("INSERT INTO favourites_data VALUES(?, ?)", [user_id, name])
-        self.sql.commit()
-        return True
+        await self.flush()  # name - id из films_names, возможно еще в очереди
+        cursor = await self.execute("INSERT OR IGNORE INTO favourites_data VALUES(?, ?)", [user_id, name])
+        return cursor.rowcount == 1
     
     async def delete_favourite(self, user_id, name):
-        self.cs.execute(f"DELETE FROM favourites_data WHERE favourites_uid = {user_id} and favourites_id = {name}")
-        self.sql.commit()
+        await self.execute("DELETE FROM favourites_data WHERE favourites_uid = ? and favourites_id = ?", [user_id, name])
     
     async def get_Allfavourite(self, type='*'):
-        self.cs.execute(f"SELECT {type} FROM favourites_data")
-        return self.cs.fetchall()
+        return await self.fetchall(f"SELECT {type} FROM favourites_data")
     
     async def get_UserAllFavourites(self, user_id):
-        self.cs.execute(f"SELECT * FROM favourites_data WHERE favourites_uid = {user_id}")
-        return self.cs.fetchall()
+        return await self.fetchall("SELECT * FROM favourites_data WHERE favourites_uid = ?", [user_id])
     
     async def get_UserFavouritesWfilm(self, user_id, name):
-        self.cs.execute(f"SELECT * FROM favourites_data WHERE favourites_uid = {user_id} and favourites_id = {name}")
-        return self.cs.fetchall()
+        return await self.fetchall("SELECT * FROM favourites_data WHERE favourites_uid = ? and favourites_id = ?", [user_id, name])
+    
+    async def get_searchCache(self, query):
+        return await self.fetchall("""SELECT film_id, film_name, film_year, film_type, film_genre,
+            film_director, film_autor, film_length, film_photo
+            FROM search_cache WHERE cache_query = ? AND cache_unix >= ? ORDER BY cache_rank""",
+                                   [query, time() - cache_db_ttl])
+    
+    async def add_searchCache(self, query, films):
+        # Подборка запроса заменяется целиком
+        def work(sql):
+            sql.execute("DELETE FROM search_cache WHERE cache_query = ?", [query])
+            sql.executemany("INSERT INTO search_cache VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(query, rank, *values, time()) for rank, values in enumerate(films)])
+        await self.transaction(work)
+    
+    async def add_mailing(self, chat_id, message_id, markup, progress_id):
+        # Список получателей фиксируется в момент создания рассылки
+        await self.flush()
+        def work(sql):
+            cursor = sql.execute("INSERT INTO mailing_data VALUES(NULL, ?, ?, ?, 'running', ?, ?)",
+                                 [chat_id, message_id, markup, progress_id, time()])
+            sql.execute("INSERT INTO mailing_users SELECT ?, user_id, 'pending' FROM user_data WHERE user_active = 1",
+                        [cursor.lastrowid])
+            return cursor.lastrowid
+        return await self.transaction(work)
+    
+    async def get_mailing(self, mailing_id):
+        return await self.fetchone("SELECT * FROM mailing_data WHERE mailing_id = ?", [mailing_id])
+    
+    async def get_AllMailing(self, status):
+        return await self.fetchall("SELECT * FROM mailing_data WHERE mailing_status = ?", [status])
+    
+    async def update_mailing_status(self, mailing_id, status):
+        await self.execute("UPDATE mailing_data SET mailing_status = ? WHERE mailing_id = ?", [status, mailing_id])
+    
+    async def get_mailingCounts(self, mailing_id):
+        rows = await self.fetchall("SELECT status, COUNT(*) FROM mailing_users WHERE mailing_id = ? GROUP BY status",
+                                   [mailing_id])
+        return dict(rows)
+    
+    def iter_mailingUsers(self, mailing_id):
+        return self.iterate("""SELECT user_id FROM mailing_users
+            WHERE mailing_id = ? AND status = 'pending' AND user_id > ? ORDER BY user_id LIMIT ?""", [mailing_id])
+    
+    async def set_mailingUser(self, mailing_id, user_id, status):
+        # Пишется сразу, а не пачкой: после падения бот не отправит сообщение повторно
+        await self.execute("UPDATE mailing_users SET status = ? WHERE mailing_id = ? AND user_id = ?",
+                           [status, mailing_id, user_id])
 
 # Инициализация БД
 db = Database()
 
+# ==================== КЭШ ====================
+class LRUCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.data = OrderedDict()
+    
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        if item[0] < time():
+            del self.data[key]
+            return None
+        self.data.move_to_end(key)
+        return item[1]
+    
+    def set(self, key, value):
+        self.data[key] = (time() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+# ==================== ШАБЛОНЫ ====================
+class Template:
+    pattern = re.compile(r'\{(\w+)\}')
+    
+    def __init__(self, text):
+        # Разбор делается один раз: четные части - текст, нечетные - имена подстановок
+        self.parts = self.pattern.split(text)
+    
+    def render(self, **values):
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            parts[i] = str(values[name]) if name in values else '{' + name + '}'
+        return ''.join(parts)
+
+class Templates:
+    def __init__(self):
+        self.cache = {}
+    
+    async def get(self, text_type):
+        template = self.cache.get(text_type)
+        if template is None:
+            text = await db.get_text(type='text_text', text_type=text_type)
+            if not text:
+                return None
+            template = self.cache[text_type] = Template(text[0][0])
+        return template
+    
+    def invalidate(self, text_type):
+        self.cache.pop(text_type, None)
+
+templates = Templates()
+
 # ==================== ПАРСЕР КИНОПОИСКА ====================
+class FilmData:
+    fields = ('id_', 'name_film_', 'year_', 'type_kino_', 'genre_',
+              'director_', 'text_autor_', 'length_', 'photo_')
+    genre_ = ''
+    director_ = ''
+    
+    def __init__(self, *values):
+        for field, value in zip(self.fields, values):
+            setattr(self, field, value)
+    
+    def values(self):
+        return [getattr(self, field, None) for field in self.fields]
+    
+    def caption(self):
+        return (f'<b>🎥 {self.type_kino_}:</b> <code>{self.name_film_}</code>\n\n'
+                f'🗓 Год производства: {self.year_}\n\n'
+                f'<b>👁 Жанры: {self.genre_}\n\n'
+                f'👥{self.text_autor_}: {self.director_}\n\n'
+                f'🔗 Длительность: {self.length_} мин</b>')
+
 class FilmParser:
-    @staticmethod
-    async def search(name_film):
-        url = f'https://www.kinopoisk.ru/index.php?kp_query={name_film}'
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        request = requests.get(url, headers=headers)
-        request.encoding = 'utf-8'
-        soup = BeautifulSoup(request.text, "html.parser")
-        
-        element = soup.find(class_='element most_wanted')
-        if not element:
-            raise Exception("Фильм не найден")
+    url = 'https://www.kinopoisk.ru/index.php'
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    }
+    # Дерево строится только для блоков результатов
+    strainer = SoupStrainer(class_=lambda value: value and 'element' in value.split())
+    
+    def __init__(self):
+        self.session = None
+        self.semaphore = asyncio.Semaphore(http_limit)
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self.cache_stats = {'memory': 0, 'db': 0, 'local': 0, 'miss': 0, 'shared': 0}
+        self.inflight = {}
+    
+    async def get_session(self):
+        # Одна сессия на весь бот: keep-alive и пул соединений
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=http_timeout),
+                connector=aiohttp.TCPConnector(limit=http_limit, ttl_dns_cache=300)
+            )
+        return self.session
+    
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+    
+    async def fetch(self, name_film):
+        session = await self.get_session()
+        async with self.semaphore:
+            async with session.get(self.url, params={'kp_query': name_film}) as response:
+                return await response.text(encoding='utf-8')
+    
+    async def search(self, name_film):
+        return (await self.search_many(name_film))[0]
+    
+    async def search_many(self, name_film):
+        # Все результаты одной выдачи, первый - самый вероятный
+        query = normalize_query(name_film)
+        films = self.cache.get(query)
+        if films:
+            self.cache_stats['memory'] += 1
+            return films
         
-        class FilmData:
-            pass
+        # Одинаковые одновременные запросы ждут одну общую загрузку
+        task = self.inflight.get(query)
+        if task is None:
+            task = asyncio.ensure_future(self.load(query, name_film))
+            self.inflight[query] = task
+            task.add_done_callback(lambda _: self.inflight.pop(query, None))
+        else:
+            self.cache_stats['shared'] += 1
+        return await asyncio.shield(task)
+    
+    async def load(self, query, name_film):
+        rows = await db.get_searchCache(query)
+        if rows:
+            self.cache_stats['db'] += 1
+            films = [FilmData(*row) for row in rows]
+            self.cache.set(query, films)
+            return films
+        
+        # Без запроса к Кинопоиску отвечаем только на точное название. Такой ответ не сохраняется:
+        # в индекс и кэш БД попадают только названия и запросы, на которые ответил сам Кинопоиск
+        films = await film_index.search(query, limit=search_results, score=1)
+        if films:
+            self.cache_stats['local'] += 1
+            self.cache.set(query, films)
+            return films
         
+        self.cache_stats['miss'] += 1
+        films = self.parse(await self.fetch(name_film))
+        for film_data in films:
+            film_index.add(film_data.name_film_, film_data.id_)
+        film_index.add(query, films[0].id_)
+        await db.add_searchCache(query, [film_data.values() for film_data in films])
+        self.cache.set(query, films)
+        return films
+    
+    @classmethod
+    def parse(cls, html):
+        soup = BeautifulSoup(html, html_parser, parse_only=cls.strainer)
+        
+        films = []
+        for element in soup.find_all(class_='element'):
+            try:
+                films.append(cls.parse_element(element))
+            except (AttributeError, KeyError, TypeError):
+                continue  # не фильм (например, персона)
+            if len(films) == search_results:
+                break
+        if not films:
+            raise Exception("Фильм не найден")
+        return films
+    
+    @staticmethod
+    def parse_element(element):
         film_data = FilmData()
         film_data.id_ = element.find(class_='pic').find('a')['data-id']
         film_data.name_film_ = element.find(class_='pic').find('img')['alt']
@@ -359,6 +979,79 @@ class FilmParser:
 
 film_parser = FilmParser()
 
+# ==================== ЛОКАЛЬНЫЙ ПОИСК ====================
+class FilmIndex:
+    async def search(self, query, limit, score=local_search_score):
+        # Кандидаты по общим триграммам из FTS5, затем точная оценка сходства
+        title = translit(normalize_query(query))
+        if not db.fts or len(title) < 3:
+            return []
+        
+        trigrams = {title[i:i + 3] for i in range(len(title) - 2)}
+        match = ' OR '.join('"' + i.replace('"', '""') + '"' for i in trigrams)
+        # Номер части и год должны совпадать: "терминатор 2" - не "терминатор"
+        numbers = re.findall(r'\d+', title)
+        scores = {}
+        for row_title, film_id in await db.search_titles(match, limit=50):
+            if re.findall(r'\d+', row_title) != numbers:
+                continue
+            ratio = SequenceMatcher(None, title, row_title).ratio()
+            if ratio >= score and ratio > scores.get(film_id, 0):
+                scores[film_id] = ratio
+        
+        results = []
+        for film_id in sorted(scores, key=scores.get, reverse=True)[:limit]:
+            row = await db.get_filmCache(film_id)
+            if row:
+                results.append(FilmData(*row))
+        return results
+    
+    def add(self, title, film_id):
+        db.add_title(translit(normalize_query(title)), film_id)
+
+film_index = FilmIndex()
+
+# ==================== КОДЫ ФИЛЬМОВ ====================
+class CodeAllocator:
+    def __init__(self, length, alphabet):
+        self.length = length
+        self.alphabet = alphabet
+        self.size = len(alphabet) ** length
+        self.name = f'film_code:{length}:{alphabet}'
+        # Шаг взаимно прост с размером: n -> (n * step + offset) % size перебирает все коды без повторов
+        self.step = next(i for i in range(int(self.size * 0.618) | 1, self.size * 2) if gcd(i, self.size) == 1)
+        self.offset = self.size // 3
+    
+    def encode(self, number):
+        number = (number * self.step + self.offset) % self.size
+        chars = []
+        for _ in range(self.length):
+            number, index = divmod(number, len(self.alphabet))
+            chars.append(self.alphabet[index])
+        return ''.join(reversed(chars))
+    
+    async def allocate(self):
+        while True:
+            number = await db.next_sequence(self.name) - 1
+            if number >= self.size:
+                return await self.find_free()
+            code = self.encode(number)
+            # Код мог быть занят вручную - берем следующий
+            if not await db.get_films(code):
+                return code
+    
+    async def find_free(self):
+        # Последовательность пройдена, но коды освобождаются удалением и отмененными генерациями
+        taken = set(await db.only_list(await db.get_AllFilms('films_code')))
+        start = randrange(self.size)
+        for i in range(self.size):
+            code = self.encode((start + i) % self.size)
+            if code not in taken:
+                return code
+        return None
+
+code_allocator = CodeAllocator(film_code_length, film_code_alphabet)
+
 # ==================== КЛАВИАТУРЫ ====================
 class Keyboards:
     def __init__(self):
@@ -383,10 +1076,13 @@ class Keyboards:
         self.admin_menu_main.row(self.ikb_close_oikb)
         
         # Меню списков
-        self.admin_menu_list = InlineKeyboardMarkup(row_width=1)
-        self.admin_menu_list.row(InlineKeyboardButton(text='Пользователи👥', callback_data='list_users_admin'))
-        self.admin_menu_list.row(InlineKeyboardButton(text='Фильмы🎥', callback_data='list_films_admin'))
-        self.admin_menu_list.row(InlineKeyboardButton(text='Каналы📢', callback_data='list_chennel_admin'))
+        self.admin_menu_list = InlineKeyboardMarkup(row_width=2)
+        self.admin_menu_list.row(InlineKeyboardButton(text='Пользователи👥 CSV', callback_data='list_users_admin'),
+                                 InlineKeyboardButton(text='JSON', callback_data='list_users_admin_json'))
+        self.admin_menu_list.row(InlineKeyboardButton(text='Фильмы🎥 CSV', callback_data='list_films_admin'),
+                                 InlineKeyboardButton(text='JSON', callback_data='list_films_admin_json'))
+        self.admin_menu_list.row(InlineKeyboardButton(text='Каналы📢 CSV', callback_data='list_chennel_admin'),
+                                 InlineKeyboardButton(text='JSON', callback_data='list_chennel_admin_json'))
         self.admin_menu_list.row(InlineKeyboardButton(text='Назад⬅️', callback_data='back_main_menu_admin'))
         
         # Меню текстов
@@ -394,15 +1090,27 @@ class Keyboards:
         self.admin_menu_text.row(InlineKeyboardButton(text='Приветствие', callback_data='chenneger_wellcome_text_settings_admin'))
         self.admin_menu_text.row(InlineKeyboardButton(text='Фильм', callback_data='chenneger_film_text_settings_admin'))
         self.admin_menu_text.row(InlineKeyboardButton(text='Назад⬅️', callback_data='back_main_menu_admin'))
+        
+        # Клавиатуры пользователя не меняются: собираем один раз
+        self.kb_user_default = self.build_kb_user(admin=False)
+        self.kb_user_admin = self.build_kb_user(admin=True)
+        
+        # Клавиатуры из плееров и каналов пересобираются, только когда список в БД поменялся
+        self.sub_list_cache = (None, None)
+        self.player_menu_cache = (None, None)
     
-    async def kb_user(self, user_id):
+    @staticmethod
+    def build_kb_user(admin):
         kb = ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
         kb.row('Поиск🔍')
         kb.insert('Избранное🌟')
-        if user_id in admin_id:
+        if admin:
             kb.insert('Админ меню')
         return kb
     
+    async def kb_user(self, user_id):
+        return self.kb_user_admin if user_id in admin_id else self.kb_user_default
+    
     def kb_back(self):
         kb = ReplyKeyboardMarkup(resize_keyboard=True)
         kb.row('Отмена❌')
@@ -420,13 +1128,17 @@ class Keyboards:
     
     async def sub_list(self):
         data_chennel = await db.get_AllChennel()
+        if self.sub_list_cache[0] is data_chennel:
+            return self.sub_list_cache[1]
+        
         sub_list = InlineKeyboardMarkup(row_width=1)
         for i in data_chennel:
             sub_list.add(InlineKeyboardButton(text=i[1], url=i[2]))
         sub_list.add(InlineKeyboardButton(text='Одна из ссылок не работает❓', callback_data='link_no_work'))
+        self.sub_list_cache = (data_chennel, sub_list)
         return sub_list
     
-    async def kb_films(self, name_films, user_id, type, id):
+    async def kb_players(self, type, id):
         ikb = InlineKeyboardMarkup(row_width=1)
         players = await db.get_Allplayer()
         for i in players:
@@ -436,6 +1148,18 @@ class Keyboards:
                     ikb.row(InlineKeyboardButton(text=i[3], url=url))
                 except:
                     pass
+        return ikb
+    
+    async def kb_films(self, name_films, user_id, type, id, number=0, count=1):
+        ikb = await self.kb_players(type, id)
+        
+        if count > 1:
+            # Листание остальных результатов того же поиска
+            ikb.row(
+                InlineKeyboardButton('◀️', callback_data=f'pick_{name_films}_{(number - 1) % count}'),
+                InlineKeyboardButton(f'{number + 1}/{count}', callback_data='pick_page'),
+                InlineKeyboardButton('▶️', callback_data=f'pick_{name_films}_{(number + 1) % count}')
+            )
         
         if not await db.get_UserFavouritesWfilm(user_id, name_films):
             ikb.row(InlineKeyboardButton('В избранное🌟', callback_data='in_favourites_' + str(name_films)))
@@ -445,13 +1169,16 @@ class Keyboards:
         return ikb
     
     async def get_Player_menu(self):
+        players = await db.get_Allplayer()
+        if self.player_menu_cache[0] is players:
+            return self.player_menu_cache[1]
+        
         ikb = InlineKeyboardMarkup(row_width=4)
         ikb.insert(InlineKeyboardButton(text='Название', callback_data='player_exemple'))
         ikb.insert(InlineKeyboardButton(text='Сайт', callback_data='player_exemple'))
         ikb.insert(InlineKeyboardButton(text='Вкл./Выкл.', callback_data='player_exemple'))
         ikb.insert(InlineKeyboardButton(text='Название на кнопке', callback_data='player_exemple'))
         
-        players = await db.get_Allplayer()
         for i in players:
             swich = '✅' if i[2] == 1 else '❌'
             ikb.insert(InlineKeyboardButton(text=i[1], callback_data='chenneger_name_player_admin'))
@@ -460,28 +1187,234 @@ class Keyboards:
             ikb.insert(InlineKeyboardButton(text=i[3], callback_data='chenneger_kbname_player_admin' + i[1]))
         
         ikb.row(InlineKeyboardButton(text='Назад⬅️', callback_data='back_main_menu_admin'))
+        self.player_menu_cache = (players, ikb)
         return ikb
 
 keyboards = Keyboards()
 
+# ==================== ДАННЫЕ БОТА ====================
+class BotInfo:
+    # Загружается при запуске, обработчики не ходят за get_me
+    def __init__(self):
+        self.me = None
+        self.id = None
+        self.mention = None
+        self.invite_name = None
+    
+    async def refresh(self):
+        self.me = await bot.get_me()
+        self.id = self.me.id
+        self.mention = self.me.mention
+        self.invite_name = f'Вход от {self.mention}'
+
+bot_info = BotInfo()
+
 # ==================== ПРОВЕРКА ПОДПИСКИ ====================
+sub_cache = LRUCache(100000, sub_cache_ttl)  # (user_id, канал) -> пользователь подписан
+sub_errors = {}  # канал -> время последнего отчета админу
+
+async def check_channel(user_id, channel):
+    key = (user_id, channel[0])
+    if sub_cache.get(key):
+        return False
+    
+    try:
+        status = await bot.get_chat_member(chat_id=channel[0], user_id=user_id)
+    except:
+        if admin_id and sub_errors.get(channel[0], 0) + sub_error_interval <= time():
+            sub_errors[channel[0]] = time()
+            await bot.send_message(
+                chat_id=admin_id[0],
+                text=f'Ошибка с каналом: {channel[1]}\nID: {channel[0]}'
+            )
+        return False
+    
+    if status.status == 'left':
+        return True
+    sub_cache.set(key, True)
+    return False
+
 async def check_subscription(user_id):
     data_chennel = await db.get_AllChennel()
     if not data_chennel:
         return False
     
-    for channel in data_chennel:
-        try:
-            status = await bot.get_chat_member(chat_id=channel[0], user_id=user_id)
-            if status.status == 'left':
-                return True
-        except:
-            if admin_id:
-                await bot.send_message(
-                    chat_id=admin_id[0],
-                    text=f'Ошибка с каналом: {channel[1]}\nID: {channel[0]}'
+    results = await asyncio.gather(*[check_channel(user_id, channel) for channel in data_chennel])
+    return any(results)
+
+# ==================== РАССЫЛКА ====================
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_time = 0
+    
+    async def wait(self):
+        # Раздает отправкам слоты не чаще rate в секунду
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_time)
+        self.next_time = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+    
+    def pause(self, seconds):
+        now = asyncio.get_running_loop().time()
+        self.next_time = max(self.next_time, now + seconds)
+
+mailing_limiter = RateLimiter(mailing_rate)
+
+def mailing_error_status(error):
+    # Пользователь недостижим навсегда - его можно исключить из рассылок
+    if isinstance(error, (BotBlocked, BotKicked)):
+        return 'blocked'
+    if isinstance(error, UserDeactivated):
+        return 'deactivated'
+    if isinstance(error, (ChatNotFound, CantInitiateConversation, CantTalkWithBots)):
+        return 'not_found'
+    return None
+mailings = {}  # mailing_id -> Mailing, которые сейчас отправляются
+
+class Mailing:
+    def __init__(self, mailing_id, chat_id, message_id, markup, status, progress_id, unix):
+        self.mailing_id = mailing_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.progress_id = progress_id
+        self.status = status
+        self.counts = {}
+        
+        self.reply_markup = None
+        ikb_list = json.loads(markup) if markup else []
+        if ikb_list:
+            self.reply_markup = InlineKeyboardMarkup(row_width=1)
+            for btn in ikb_list:
+                self.reply_markup.row(InlineKeyboardButton(text=btn['text'], url=btn['url']))
+    
+    def text(self):
+        text = (f'<b>Данные о рассылке #{self.mailing_id}\n'
+                f'✅Успешно: {self.counts.get("sent", 0)}\n'
+                f'🚫Заблокировали бота: {self.counts.get("blocked", 0)}\n'
+                f'👻Удалены/не найдены: {self.counts.get("deactivated", 0) + self.counts.get("not_found", 0)}\n'
+                f'❌Ошибки: {self.counts.get("failed", 0)}\n'
+                f'⏳Осталось: {self.counts.get("pending", 0)}')
+        if self.status == 'finished':
+            text += '\nРассылка завершена🔔'
+        elif self.status == 'paused':
+            text += '\nРассылка на паузе⏸'
+        return text + '</b>'
+    
+    def markup(self):
+        if self.status == 'running':
+            return InlineKeyboardMarkup().row(
+                InlineKeyboardButton(text='Пауза⏸', callback_data=f'mailing_pause_{self.mailing_id}'))
+        if self.status == 'paused':
+            return InlineKeyboardMarkup().row(
+                InlineKeyboardButton(text='Продолжить▶️', callback_data=f'mailing_resume_{self.mailing_id}'),
+                keyboards.ikb_close_oikb)
+        return keyboards.ikb_close
+    
+    async def users(self):
+        # Получатели, которым еще не отправляли, читаются из БД постранично
+        async for row in db.iter_mailingUsers(self.mailing_id):
+            if self.status != 'running':
+                return
+            yield row[0]
+    
+    async def done(self, user_id, status):
+        self.counts['pending'] = self.counts.get('pending', 0) - 1
+        self.counts[status] = self.counts.get(status, 0) + 1
+        await db.set_mailingUser(self.mailing_id, user_id, status)
+    
+    async def send(self, user_id):
+        attempt = 0
+        while True:
+            await mailing_limiter.wait()
+            if self.status != 'running':
+                return
+            try:
+                await bot.copy_message(
+                    chat_id=user_id,
+                    from_chat_id=self.chat_id,
+                    message_id=self.message_id,
+                    reply_markup=self.reply_markup
                 )
-    return False
+                await self.done(user_id, 'sent')
+                return
+            except RetryAfter as e:
+                # Telegram просит подождать: притормаживаем всю рассылку
+                mailing_limiter.pause(e.timeout)
+            except Exception as e:
+                status = mailing_error_status(e)
+                if status:
+                    db.deactivate_user(user_id)
+                    await self.done(user_id, status)
+                    return
+                attempt += 1
+                if attempt >= mailing_attempts:
+                    logging.warning(f'Рассылка #{self.mailing_id}: не доставлено {user_id}: {e}')
+                    await self.done(user_id, 'failed')
+                    return
+                await asyncio.sleep(attempt)
+    
+    async def worker(self, queue):
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            # После паузы оставшиеся в очереди получатели остаются pending
+            if self.status == 'running':
+                await self.send(user_id)
+    
+    async def progress(self):
+        last_text = None
+        while True:
+            await asyncio.sleep(mailing_progress_interval)
+            text = self.text()
+            if text != last_text:
+                await self.edit_progress()
+                last_text = text
+    
+    async def edit_progress(self):
+        try:
+            await bot.edit_message_text(
+                chat_id=self.chat_id,
+                message_id=self.progress_id,
+                text=self.text(),
+                parse_mode=types.ParseMode.HTML,
+                reply_markup=self.markup()
+            )
+        except MessageNotModified:
+            pass
+        except RetryAfter as e:
+            await asyncio.sleep(e.timeout)
+    
+    async def run(self):
+        self.counts = await db.get_mailingCounts(self.mailing_id)
+        queue = asyncio.Queue(maxsize=mailing_workers * 2)
+        workers = [asyncio.create_task(self.worker(queue)) for _ in range(mailing_workers)]
+        progress = asyncio.create_task(self.progress())
+        
+        try:
+            async for user_id in self.users():
+                await queue.put(user_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            progress.cancel()
+            for worker in workers:
+                worker.cancel()
+            mailings.pop(self.mailing_id, None)
+        
+        if self.status == 'running':
+            self.status = 'finished'
+        await db.update_mailing_status(self.mailing_id, self.status)
+        await self.edit_progress()
+
+def start_mailing(row):
+    mailing = Mailing(*row)
+    mailings[mailing.mailing_id] = mailing
+    mailing.task = asyncio.create_task(mailing.run())
+    return mailing
 
 # ==================== АНТИ-ФЛУД ====================
 async def anti_flood(*args, **kwargs):
@@ -489,6 +1422,29 @@ async def anti_flood(*args, **kwargs):
     await m.answer(f'Фильм можно найти раз в {rate_searsh} секунд😪', 
                    reply_markup=await keyboards.kb_user(m.from_user.id))
 
+# ==================== АКТИВНОСТЬ ====================
+class ActivityMiddleware(BaseMiddleware):
+    def __init__(self):
+        super().__init__()
+        # Время активности пишется не чаще раза в activity_interval на пользователя
+        self.seen = LRUCache(100000, activity_interval)
+    
+    def touch(self, user_id):
+        if not self.seen.get(user_id):
+            self.seen.set(user_id, True)
+            db.touch_user(user_id)
+    
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        self.touch(message.from_user.id)
+    
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        self.touch(call.from_user.id)
+    
+    async def on_pre_process_inline_query(self, query: types.InlineQuery, data: dict):
+        self.touch(query.from_user.id)
+
+dp.middleware.setup(ActivityMiddleware())
+
 # ==================== ОБЩИЕ ОБРАБОТЧИКИ ====================
 @dp.callback_query_handler(text='cancellation_state', state='*')
 async def cancellation_state(call: types.CallbackQuery, state: FSMContext):
@@ -565,15 +1521,15 @@ async def cmd_start(message: types.Message):
         except:
             pass
         
-        text_start = await db.get_text(type='text_text', text_type='wellcome')
-        if text_start:
-            text_start = text_start[0][0]
-            me = await bot.get_me()
-            text_start = text_start.replace('{username_bot}', me.mention)
-            text_start = text_start.replace('{bot_id}', str(me.id))
-            text_start = text_start.replace('{username}', message.from_user.mention)
-            text_start = text_start.replace('{full_name}', message.from_user.full_name)
-            text_start = text_start.replace('{user_id}', str(message.from_user.id))
+        template = await templates.get('wellcome')
+        if template:
+            text_start = template.render(
+                username_bot=bot_info.mention,
+                bot_id=bot_info.id,
+                username=message.from_user.mention,
+                full_name=message.from_user.full_name,
+                user_id=message.from_user.id
+            )
             
             await message.answer(
                 text=text_start,
@@ -599,60 +1555,62 @@ async def search_kino_parser(message: types.Message, state: FSMContext):
         )
         return
     
-    # Проверка кода
-    data_code = await db.only_list(await db.get_AllFilms(type='films_code'))
-    if message.text in data_code:
+    # Проверка кода: один запрос по первичному ключу
+    film_data = await db.get_films(code=message.text)
+    if film_data:
         await message.answer('Фильм найден!', reply_markup=await keyboards.kb_user(message.from_user.id))
-        film_data = await db.get_films(code=message.text)
-        
-        if film_data:
-            text_film = await db.get_text(type='text_text', text_type='film')
-            if text_film:
-                text_film = text_film[0][0]
-                me = await bot.get_me()
-                text_film = text_film.replace('{username_bot}', me.mention)
-                text_film = text_film.replace('{bot_id}', str(me.id))
-                text_film = text_film.replace('{username}', message.from_user.mention)
-                text_film = text_film.replace('{full_name}', message.from_user.full_name)
-                text_film = text_film.replace('{user_id}', str(message.from_user.id))
-                text_film = text_film.replace('{film_name}', film_data[0][1])
-                
-                try:
+        
+        template = await templates.get('film')
+        if template:
+            text_film = template.render(
+                username_bot=bot_info.mention,
+                bot_id=bot_info.id,
+                username=message.from_user.mention,
+                full_name=message.from_user.full_name,
+                user_id=message.from_user.id,
+                film_name=film_data[0][1]
+            )
+            
+            try:
+                kp_id, kp_type = film_data[0][4], film_data[0][5]
+                if not kp_id:
+                    # Старые записи дополняем при первом открытии
                     data_film = await film_parser.search(name_film=film_data[0][1])
-                    ikb_films = await keyboards.kb_films(
-                        name_films=film_data[0][3],
-                        user_id=message.from_user.id,
-                        type=data_film.type_kino_,
-                        id=data_film.id_
-                    )
-                    await bot.send_photo(
-                        chat_id=message.from_user.id,
-                        photo=film_data[0][2],
-                        caption=text_film,
-                        reply_markup=ikb_films,
-                        parse_mode=types.ParseMode.HTML
-                    )
-                except Exception as e:
-                    print(f"Ошибка при поиске фильма: {e}")
-                    await message.answer('Ошибка при получении данных о фильме😥')
+                    kp_id, kp_type = data_film.id_, data_film.type_kino_
+                    await db.update_film_kp(code=message.text, kp_id=kp_id, kp_type=kp_type)
+                
+                ikb_films = await keyboards.kb_films(
+                    name_films=film_data[0][3],
+                    user_id=message.from_user.id,
+                    type=kp_type,
+                    id=kp_id
+                )
+                await bot.send_photo(
+                    chat_id=message.from_user.id,
+                    photo=film_data[0][2],
+                    caption=text_film,
+                    reply_markup=ikb_films,
+                    parse_mode=types.ParseMode.HTML
+                )
+            except Exception as e:
+                print(f"Ошибка при поиске фильма: {e}")
+                await message.answer('Ошибка при получении данных о фильме😥')
     else:
         try:
-            data_film = await film_parser.search(name_film=message.text)
-            film_id = await db.add_filmname(message.text)
+            films = await film_parser.search_many(name_film=message.text)
+            data_film = films[0]
+            film_id = await db.add_filmname(message.text, data_film.values())
             
             await bot.send_photo(
                 chat_id=message.from_user.id,
                 photo=data_film.photo_,
-                caption=f'<b>🎥 {data_film.type_kino_}:</b> <code>{data_film.name_film_}</code>\n\n'
-                       f'🗓 Год производства: {data_film.year_}\n\n'
-                       f'<b>👁 Жанры: {data_film.genre_}\n\n'
-                       f'👥{data_film.text_autor_}: {data_film.director_}\n\n'
-                       f'🔗 Длительность: {data_film.length_} мин</b>',
+                caption=data_film.caption(),
                 reply_markup=await keyboards.kb_films(
                     name_films=film_id,
                     user_id=message.from_user.id,
                     type=data_film.type_kino_,
-                    id=data_film.id_
+                    id=data_film.id_,
+                    count=len(films)
                 ),
                 parse_mode=types.ParseMode.HTML
             )
@@ -672,7 +1630,13 @@ async def search_film_with_call(call: types.CallbackQuery):
     
     if name:
         try:
-            data_film = await film_parser.search(name_film=name[1])
+            if name[2]:
+                data_film = FilmData(*name[2:])
+            else:
+                # Старые записи дополняем при первом открытии
+                data_film = await film_parser.search(name_film=name[1])
+                await db.update_filmname_kp(id=film_id, kp_values=data_film.values())
+            
             ikb = await keyboards.kb_films(
                 name_films=int(film_id),
                 user_id=call.from_user.id,
@@ -684,11 +1648,7 @@ async def search_film_with_call(call: types.CallbackQuery):
             await bot.send_photo(
                 chat_id=call.from_user.id,
                 photo=data_film.photo_,
-                caption=f'<b>🎥 {data_film.type_kino_}: </b><code>{data_film.name_film_}</code>\n\n'
-                       f'🗓 Год производства: {data_film.year_}\n\n'
-                       f'<b>👁 Жанры: {data_film.genre_}\n\n'
-                       f'👥{data_film.text_autor_}: {data_film.director_}\n\n'
-                       f'🔗 Длительность: {data_film.length_} мин</b>',
+                caption=data_film.caption(),
                 reply_markup=ikb,
                 parse_mode=types.ParseMode.HTML
             )
@@ -697,6 +1657,48 @@ async def search_film_with_call(call: types.CallbackQuery):
             print(f"Ошибка: {e}")
             await call.answer('Ошибка при загрузке фильма', show_alert=True)
 
+@dp.callback_query_handler(text='pick_page')
+async def pick_page(call: types.CallbackQuery):
+    await call.answer()
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith('pick_'))
+async def pick_film(call: types.CallbackQuery):
+    # Другой результат той же выдачи берется из кэша, без нового запроса к Кинопоиску
+    film_id, number = call.data[5:].split('_')
+    name = await db.get_filmname(film_id)
+    if not name:
+        await call.answer('Ошибка при загрузке фильма', show_alert=True)
+        return
+    
+    try:
+        films = await film_parser.search_many(name_film=name[1])
+        number = int(number) % len(films)
+        data_film = films[number]
+        # Избранное и повторное открытие показывают выбранный вариант
+        await db.update_filmname_kp(id=film_id, kp_values=data_film.values())
+        
+        await call.message.edit_media(
+            types.InputMediaPhoto(
+                media=data_film.photo_,
+                caption=data_film.caption(),
+                parse_mode=types.ParseMode.HTML
+            ),
+            reply_markup=await keyboards.kb_films(
+                name_films=int(film_id),
+                user_id=call.from_user.id,
+                type=data_film.type_kino_,
+                id=data_film.id_,
+                number=number,
+                count=len(films)
+            )
+        )
+        await call.answer()
+    except MessageNotModified:
+        await call.answer()
+    except Exception as e:
+        print(f"Ошибка: {e}")
+        await call.answer('Ошибка при загрузке фильма', show_alert=True)
+
 @dp.callback_query_handler(text='back_to_favorites')
 async def back_to_favorites(call: types.CallbackQuery):
     await call.message.delete()
@@ -783,6 +1785,51 @@ async def link_complaint(call: types.CallbackQuery):
     else:
         await call.answer('Вы уже жаловались❌')
 
+# ==================== INLINE-РЕЖИМ ====================
+# Включается у @BotFather командой /setinline
+inline_cache = LRUCache(cache_size, inline_cache_time)  # запрос -> готовые результаты
+
+async def inline_results(query):
+    # Только локальные данные: кэш поиска и индекс названий, без запросов к Кинопоиску
+    films = [FilmData(*row) for row in await db.get_searchCache(query)]
+    for film in await film_index.search(query, limit=inline_limit):
+        if all(film.id_ != i.id_ for i in films):
+            films.append(film)
+    
+    results = []
+    for film in films[:inline_limit]:
+        results.append(types.InlineQueryResultPhoto(
+            id=str(film.id_),
+            photo_url=film.photo_,
+            thumb_url=film.photo_,
+            title=film.name_film_,
+            description=f'{film.type_kino_}, {film.year_}',
+            caption=film.caption(),
+            parse_mode=types.ParseMode.HTML,
+            reply_markup=await keyboards.kb_players(film.type_kino_, film.id_)
+        ))
+    return results
+
+@dp.inline_handler()
+async def inline_search(inline_query: types.InlineQuery):
+    # Без каналов ответ одинаков для всех, и Telegram может раздавать его из своего кэша
+    personal = bool(await db.get_AllChennel())
+    if personal and await check_subscription(user_id=inline_query.from_user.id):
+        await inline_query.answer([], cache_time=0, is_personal=True,
+                                  switch_pm_text='Подпишитесь на каналы❌', switch_pm_parameter='sub')
+        return
+    
+    query = normalize_query(inline_query.query)
+    if not query:
+        await inline_query.answer([], cache_time=inline_cache_time, is_personal=personal)
+        return
+    
+    results = inline_cache.get(query)
+    if results is None:
+        results = await inline_results(query)
+        inline_cache.set(query, results)
+    await inline_query.answer(results, cache_time=inline_cache_time, is_personal=personal)
+
 # ==================== ОБРАБОТЧИКИ АДМИНИСТРАТОРА ====================
 
 @dp.message_handler(lambda message: message.from_user.id in admin_id and message.text in ['/admin', 'Админ меню'])
@@ -791,36 +1838,34 @@ async def cmd_admin(message: types.Message):
                               reply_markup=keyboards.admin_menu_main, 
                               parse_mode=types.ParseMode.HTML)
     
-    # Статистика
+    # Статистика: счетчики из stats_data и запросы по индексам
     now = datetime.now()
-    day_start = datetime(now.year, now.month, now.day, 0, 0, 0)
-    day_end = datetime(now.year, now.month, now.day, 23, 59, 59)
-    
-    user_today = 0
-    all_users = await db.get_AllUser()
-    for user in all_users:
-        if len(user) > 3 and user[3]:
-            if day_start.timestamp() <= user[3] <= day_end.timestamp():
-                user_today += 1
-    
-    all_search = await db.get_AllSearch()
-    search_dict = {}
-    for s in all_search:
-        if len(s) > 1:
-            search_dict[s[0]] = s[1]
-    
-    max_film = 'Нет'
-    max_count = ''
-    if search_dict:
-        max_film = max(search_dict, key=search_dict.get)
-        max_count = search_dict[max_film]
+    day_start = datetime(now.year, now.month, now.day).timestamp()
+    
+    stats, user_today, dau, wau, mau, top_search = await asyncio.gather(
+        db.get_Stats(),
+        db.get_countUsers('user_unix', day_start),
+        db.get_countUsers('user_last_unix', time() - 24 * 3600),
+        db.get_countUsers('user_last_unix', time() - 7 * 24 * 3600),
+        db.get_countUsers('user_last_unix', time() - 30 * 24 * 3600),
+        db.get_topSearch(stats_top)
+    )
+    
+    text_top = ''.join(f'\n{i}. {quote_html(name)} ({count})' for i, (name, count) in enumerate(top_search, 1))
     
     text_menu = (f'<b>📊Статистика📊\n\n'
-                 f'👥Всего пользователей: {len(all_users)}\n'
-                 f'🍜Сегодняшние пользователи: {user_today}\n\n'
+                 f'👥Всего пользователей: {stats.get("users", 0)}\n'
+                 f'📬Доступны для рассылки: {stats.get("users_active", 0)}\n'
+                 f'🍜Сегодняшние пользователи: {user_today}\n'
+                 f'📈Активные за день/неделю/месяц: {dau}/{wau}/{mau}\n\n'
+                 f'➖➖➖➖➖➖➖➖➖\n\n'
+                 f'🎬Всего фильмов по коду: {stats.get("films", 0)}\n'
+                 f'🎞Топ по запросам:{text_top or " Нет"}\n\n'
                  f'➖➖➖➖➖➖➖➖➖\n\n'
-                 f'🎬Всего фильмов по коду: {len(await db.get_AllFilms())}\n'
-                 f'🎞Макс по запросам: {max_film} ({max_count})</b>')
+                 f'🗃Кэш поиска: память {film_parser.cache_stats["memory"]}, '
+                 f'БД {film_parser.cache_stats["db"]}, локально {film_parser.cache_stats["local"]}, '
+                 f'промахи {film_parser.cache_stats["miss"]}, '
+                 f'общие {film_parser.cache_stats["shared"]}</b>')
     
     await bot.edit_message_text(
         chat_id=message.from_user.id,
@@ -940,84 +1985,70 @@ async def back_to_mailing(call: types.CallbackQuery, state: FSMContext):
                    content_types=types.ContentTypes.ANY)
 async def mailing_send(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    users = await db.only_list(await db.get_AllUser(type='user_id'))
-    count_accept = 0
-    count_error = 0
-    
-    ikb = InlineKeyboardMarkup(row_width=1)
-    for btn in data.get('ikb_list', []):
-        ikb.row(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-    
-    await bot.edit_message_text(
-        chat_id=message.from_user.id,
-        message_id=data['message_id'],
-        text=f'<b>Данные о рассылке\n✅Успешно: {count_accept}\n❌Ошибки: {count_error}</b>',
-        parse_mode=types.ParseMode.HTML
-    )
-    
-    for user_id in users:
-        try:
-            await bot.copy_message(
-                chat_id=user_id,
-                from_chat_id=message.from_user.id,
-                message_id=message.message_id,
-                reply_markup=ikb if data.get('ikb_list') else None
-            )
-            count_accept += 1
-        except:
-            count_error += 1
-        
-        await bot.edit_message_text(
-            chat_id=message.from_user.id,
-            message_id=data['message_id'],
-            text=f'<b>Данные о рассылке\n✅Успешно: {count_accept}\n❌Ошибки: {count_error}</b>',
-            parse_mode=types.ParseMode.HTML
-        )
+    await state.finish()
     
-    await bot.edit_message_text(
+    mailing_id = await db.add_mailing(
         chat_id=message.from_user.id,
-        message_id=data['message_id'],
-        text=f'<b>Данные о рассылке\n✅Успешно: {count_accept}\n❌Ошибки: {count_error}\nРассылка завершена🔔</b>',
-        parse_mode=types.ParseMode.HTML,
-        reply_markup=keyboards.ikb_close
+        message_id=message.message_id,
+        markup=json.dumps(data.get('ikb_list', []), ensure_ascii=False),
+        progress_id=data['message_id']
     )
-    
-    await state.finish()
+    mailing = start_mailing(await db.get_mailing(mailing_id))
+    await mailing.edit_progress()
+
+@dp.callback_query_handler(lambda c: c.from_user.id in admin_id and c.data.startswith('mailing_pause_'))
+async def mailing_pause(call: types.CallbackQuery):
+    mailing = mailings.get(int(call.data[14:]))
+    if mailing:
+        mailing.status = 'paused'
+    await call.answer('Рассылка на паузе⏸')
+
+@dp.callback_query_handler(lambda c: c.from_user.id in admin_id and c.data.startswith('mailing_resume_'))
+async def mailing_resume(call: types.CallbackQuery):
+    mailing_id = int(call.data[15:])
+    mailing = mailings.get(mailing_id)
+    if mailing and mailing.status == 'paused':
+        # Воркеры еще дорабатывают очередь, новая рассылка стартует после их остановки
+        await call.answer('Рассылка еще останавливается, повторите через пару секунд⏳', show_alert=True)
+        return
+    if not mailing:
+        await db.update_mailing_status(mailing_id, 'running')
+        mailing = start_mailing(await db.get_mailing(mailing_id))
+        await mailing.edit_progress()
+    await call.answer('Рассылка продолжена▶️')
 
 # Списки
 @dp.callback_query_handler(lambda c: c.from_user.id in admin_id and c.data == 'list_data_admin')
 async def list_data_menu(call: types.CallbackQuery):
     await call.message.edit_reply_markup(keyboards.admin_menu_list)
 
-@dp.callback_query_handler(lambda c: c.from_user.id in admin_id and c.data == 'list_users_admin')
-async def list_users(call: types.CallbackQuery):
-    filename = 'users_data.txt'
-    with open(filename, 'w', encoding='UTF-8') as f:
-        for user in await db.get_AllUser():
-            f.write(f'ID: {user[0]}, Username: {user[1]}\n')
+async def send_export(call, name, query, header):
+    format = 'json' if call.data.endswith('_json') else 'csv'
+    await call.answer('Готовлю файл...')
+    file, compressed = await db.export(query=query, header=header, format=format)
     
-    with open(filename, 'rb') as f:
-        await bot.send_document(chat_id=call.from_user.id, document=f, reply_markup=keyboards.ikb_close)
+    filename = f'{name}.{format}' + ('.gz' if compressed else '')
+    with file:
+        await bot.send_document(
+            chat_id=call.from_user.id,
+            document=types.InputFile(file, filename=filename),
+            reply_markup=keyboards.ikb_close
+        )
+
+@dp.callback_query_handler(lambda c: c.from_user.id in admin_id and c.data in ['list_users_admin', 'list_users_admin_json'])
+async def list_users(call: types.CallbackQuery):
+    await send_export(call, 'users_data', query='SELECT user_id, user_menotion FROM user_data',
+                      header=['id', 'username'])
 
-@dp.callback_query_handler(lambda c: c.from_user.id in admin_id and c.data == 'list_films_admin')
+@dp.callback_query_handler(lambda c: c.from_user.id in admin_id and c.data in ['list_films_admin', 'list_films_admin_json'])
 async def list_films(call: types.CallbackQuery):
-    filename = 'films_data.txt'
-    with open(filename, 'w', encoding='UTF-8') as f:
-        for film in await db.get_AllFilms():
-            f.write(f'Код: {film[0]}, Название: {film[1]}\n')
-    
-    with open(filename, 'rb') as f:
-        await bot.send_document(chat_id=call.from_user.id, document=f, reply_markup=keyboards.ikb_close)
+    await send_export(call, 'films_data', query='SELECT films_code, films_name FROM films_data',
+                      header=['code', 'name'])
 
-@dp.callback_query_handler(lambda c: c.from_user.id in admin_id and c.data == 'list_chennel_admin')
+@dp.callback_query_handler(lambda c: c.from_user.id in admin_id and c.data in ['list_chennel_admin', 'list_chennel_admin_json'])
 async def list_channels(call: types.CallbackQuery):
-    filename = 'channels_data.txt'
-    with open(filename, 'w', encoding='UTF-8') as f:
-        for channel in await db.get_AllChennel():
-            f.write(f'ID: {channel[0]}, Название: {channel[1]}, Ссылка: {channel[2]}\n')
-    
-    with open(filename, 'rb') as f:
-        await bot.send_document(chat_id=call.from_user.id, document=f, reply_markup=keyboards.ikb_close)
+    await send_export(call, 'channels_data', query='SELECT * FROM chennel_data',
+                      header=['id', 'name', 'link'])
 
 # Добавление фильма
 @dp.callback_query_handler(lambda c: c.from_user.id in admin_id and c.data == 'add_film_admin')
@@ -1037,12 +2068,10 @@ async def add_film_start(call: types.CallbackQuery, state: FSMContext):
 @dp.callback_query_handler(lambda c: c.from_user.id in admin_id and c.data == 'generetion_fims_code_admin', 
                           state=AdminState.add_film_code)
 async def generate_film_code(call: types.CallbackQuery, state: FSMContext):
-    existing_codes = await db.only_list(await db.get_AllFilms(type='films_code'))
-    
-    while True:
-        code = str(randint(0, 9999))
-        if code not in existing_codes:
-            break
+    code = await code_allocator.allocate()
+    if code is None:
+        await call.answer('Свободные коды закончились, увеличьте film_code_length❌', show_alert=True)
+        return
     
     await state.update_data(code=code)
     
@@ -1073,12 +2102,13 @@ async def add_film_name(message: types.Message, state: FSMContext):
     
     try:
         film_data = await film_parser.search(name_film=message.text)
-        film_id = await db.add_filmname(data['name'])
-        await db.add_film(code=data['code'], name=data['name'], priv=film_data.photo_, id=film_id)
+        film_id = await db.add_filmname(message.text, film_data.values())
+        await db.add_film(code=data['code'], name=message.text, priv=film_data.photo_, id=film_id,
+                          kp_id=film_data.id_, kp_type=film_data.type_kino_)
         
         await message.answer_photo(
             photo=film_data.photo_,
-            caption=f'📌Фильм добавлен\n🔑Код: <code>{data["code"]}</code>\n🎫Название: {data["name"]}',
+            caption=f'📌Фильм добавлен\n🔑Код: <code>{data["code"]}</code>\n🎫Название: {message.text}',
             reply_markup=keyboards.ikb_close,
             parse_mode=types.ParseMode.HTML
         )
@@ -1176,8 +2206,7 @@ async def add_channel_username(message: types.Message, state: FSMContext):
         
         try:
             chat = await bot.get_chat(chat_id=channel_id)
-            me = await bot.get_me()
-            link = await bot.create_chat_invite_link(chat_id=channel_id, name=f'Вход от {me.mention}')
+            link = await bot.create_chat_invite_link(chat_id=channel_id, name=bot_info.invite_name)
             
             await db.add_Chennel(chennel_identifier=str(channel_id), name=chat.full_name, link=link.invite_link)
             
@@ -1246,7 +2275,8 @@ async def check_channels(call: types.CallbackQuery):
         text='Хорошо, я проверяю, подождите♻️'
     )
     
-    me = await bot.get_me()
+    # Полная проверка каналов заодно обновляет данные бота
+    await bot_info.refresh()
     text = ''
     
     channels = await db.get_AllChennel()
@@ -1258,7 +2288,7 @@ async def check_channels(call: types.CallbackQuery):
             
             has_invite_permission = False
             for admin in admins:
-                if admin.user.id == me.id:
+                if admin.user.id == bot_info.id:
                     has_invite_permission = admin.can_invite_users
                     break
             
@@ -1368,6 +2398,7 @@ async def save_welcome_text(message: types.Message, state: FSMContext):
             parse_mode=types.ParseMode.HTML
         )
         await db.update_wellcome_text(text_type='wellcome', text=message.text)
+        templates.invalidate('wellcome')
         
         await bot.edit_message_text(
             chat_id=message.from_user.id,
@@ -1417,6 +2448,7 @@ async def save_film_text(message: types.Message, state: FSMContext):
             parse_mode=types.ParseMode.HTML
         )
         await db.update_wellcome_text(text_type='film', text=message.text)
+        templates.invalidate('film')
         
         await bot.edit_message_text(
             chat_id=message.from_user.id,
@@ -1452,7 +2484,24 @@ async def empty_command(message: types.Message):
                         reply_markup=await keyboards.kb_user(message.from_user.id))
 
 # ==================== ЗАПУСК БОТА ====================
-if __name__ == '__main__':
+async def on_startup(dp):
+    dp['db_flush'] = asyncio.create_task(db.flush_loop())
+    await bot_info.refresh()
+    await db.load_registry('player_data')
+    await db.load_registry('chennel_data')
+    # Продолжаем рассылки, прерванные перезапуском
+    for row in await db.get_AllMailing('running'):
+        start_mailing(row)
     print("Бот запущен!")
+
+async def on_shutdown(dp):
+    await film_parser.close()
+    for mailing in list(mailings.values()):
+        mailing.task.cancel()
+    dp['db_flush'].cancel()
+    await db.flush()
+    db.close()
+
+if __name__ == '__main__':
     print("Настройте токен и admin_id в начале файла!")
-    executor.start_polling(dp, skip_updates=True)
\ No newline at end of file
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)